@@ -3,7 +3,17 @@ import pandas as pd
 import plotly.graph_objects as go
 from plotly.colors import qualitative
 from io import BytesIO
+import functools
+import hashlib
+import inspect
+import json
+import os
+import tempfile
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+from python_calamine import CalamineWorkbook
+from sheet_utils import PARQUET_MANIFEST, blank_to_none, bystrat_header_map, split_sheet_name
 
 # ==================================================
 # Page config
@@ -20,56 +30,228 @@ tab_corr, tab_stress, tab_legenda = st.tabs(
 # ==================================================
 # DATA LOADING
 # ==================================================
+def read_sheet(wb, sheet):
+    """Legge un sheet da un workbook calamine già aperto (prima riga = header)"""
+    rows = wb.get_sheet_by_name(sheet).to_python(skip_empty_area=False)
+    return pd.DataFrame(blank_to_none(rows[1:]), columns=rows[0])
+
+def parquet_dir(path):
+    """Cartella Parquet generata da convert_to_parquet.py; None (→ fallback xlsx) se assente
+    o più vecchia dell'xlsx"""
+    out_dir = os.path.splitext(path)[0]
+    manifest = os.path.join(out_dir, PARQUET_MANIFEST)
+    if os.path.exists(manifest) and os.path.getmtime(manifest) >= os.path.getmtime(path):
+        return out_dir
+    return None
+
+def sheet_names(path):
+    """Sheet del workbook nell'ordine originale (dal manifest Parquet o dall'xlsx)"""
+    pq_dir = parquet_dir(path)
+    if pq_dir:
+        with open(os.path.join(pq_dir, PARQUET_MANIFEST)) as f:
+            return json.load(f)
+    return CalamineWorkbook.from_path(path).sheet_names
+
+STRESS_PARTITIONING = ds.partitioning(
+    pa.schema([("Portfolio", pa.string()), ("ScenarioName", pa.string())]),
+    flavor="hive"
+)
+
+# colonne dei DataFrame stress (i loader restituiscono MultiIndex ordinati su
+# Date/Portfolio/ScenarioName[/Name] → i filtri della UI sono ricerche O(log N))
+STRESS_COLS = ["Date", "Scenario", "StressPnL", "Portfolio", "ScenarioName"]
+BYSTRAT_COLS = ["Name", "Date", "StressPnL", "Portfolio", "ScenarioName"]
+
+CACHE_DIR = ".cache"
+# da incrementare quando cambiano gli helper dei loader (read_sheet, sheet_utils,
+# STRESS_COLS, ...): il sorgente del loader da solo non li copre
+CACHE_VERSION = 5
+
+def source_files(path):
+    """File effettivamente letti dai loader: la cartella Parquet se in uso, altrimenti l'xlsx"""
+    pq_dir = parquet_dir(path)
+    if not pq_dir:
+        return [path]
+    return sorted(
+        os.path.join(root, f)
+        for root, _, files in os.walk(pq_dir)
+        for f in files
+    )
+
+def prune_cache(func_name, prefix, keep):
+    """Rimuove le voci superate: stesso loader e argomenti con chiave diversa,
+    oppure nel vecchio formato <loader>_<hash>.parquet"""
+    for name in os.listdir(CACHE_DIR):
+        path = os.path.join(CACHE_DIR, name)
+        if not name.startswith(f"{func_name}_") or not name.endswith(".parquet") or path == keep:
+            continue
+        legacy = name.count("_") == func_name.count("_") + 1
+        if name.startswith(prefix) or legacy:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass  # già rimossa da un'altra sessione
+
+def disk_cache(func):
+    """Cache su disco (Parquet) del risultato, indicizzata sull'hash dei file letti,
+    del codice del loader e di CACHE_VERSION. Nome file: <loader>_<hash argomenti>_<hash contenuto>,
+    una sola voce valida per combinazione di argomenti (le precedenti vengono rimosse)"""
+    source = inspect.getsource(func)
+
+    @functools.wraps(func)
+    def wrapper(path, *args):
+        args_key = hashlib.blake2b(repr((path,) + args).encode(), digest_size=8).hexdigest()
+        h = hashlib.blake2b((str(CACHE_VERSION) + source + repr(args)).encode())
+        for file in source_files(path):
+            h.update(file.encode())
+            with open(file, "rb") as f:
+                h.update(f.read())
+        prefix = f"{func.__name__}_{args_key}_"
+        cache_path = os.path.join(CACHE_DIR, f"{prefix}{h.hexdigest()}.parquet")
+        if os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
+        df = func(path, *args)
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # scrittura su file temporaneo + os.replace: un'altra sessione non legge mai un file a metà
+        fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+        os.close(fd)
+        try:
+            df.to_parquet(tmp_path, compression="zstd")
+            os.replace(tmp_path, cache_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        prune_cache(func.__name__, prefix, cache_path)
+        return df
+    return wrapper
+
+def sheet_categories(path):
+    """Categorical ordinati per Portfolio e ScenarioName, nell'ordine di prima apparizione tra i sheet
+    (<Portfolio>&&<ScenarioName>) del workbook: il MultiIndex ordinato segue l'ordine dell'Excel"""
+    pairs = [split_sheet_name(s) for s in sheet_names(path)]
+    portfolios = pd.CategoricalDtype(list(dict.fromkeys(p for p, _ in pairs)), ordered=True)
+    scenarios = pd.CategoricalDtype(list(dict.fromkeys(s for _, s in pairs)), ordered=True)
+    return portfolios, scenarios
+
+def sheet_positions(path):
+    """(Portfolio, ScenarioName) → posizione del sheet nel workbook, per ripristinare l'ordine dell'Excel:
+    l'ordine degli scenari varia da portafoglio a portafoglio, un unico categorical ordinato non basta"""
+    return {
+        split_sheet_name(s): i
+        for i, s in enumerate(sheet_names(path))
+    }
+
 @st.cache_data
 def load_corr_sheets(path):
     """Ritorna la lista dei sheet di un file Excel"""
-    xls = pd.ExcelFile(path)
-    return xls.sheet_names
+    return sheet_names(path)
 
 @st.cache_data
+@disk_cache
 def load_corr_data(path, sheet):
     """Carica i dati di un sheet specifico e imposta la prima colonna come index datetime"""
-    df = pd.read_excel(path, sheet_name=sheet)
+    pq_dir = parquet_dir(path)
+    if pq_dir:
+        df = pd.read_parquet(os.path.join(pq_dir, f"{sheet}.parquet"), engine="pyarrow")
+    else:
+        df = pd.read_excel(path, sheet_name=sheet, engine="calamine")
     df.iloc[:, 0] = pd.to_datetime(df.iloc[:, 0])
     return df.set_index(df.columns[0]).sort_index()
 
 @st.cache_data
+@disk_cache
 def load_stress_data(path):
-    xls = pd.ExcelFile(path)
-    records = []
-    for sheet in xls.sheet_names:
-        portfolio, scenario_name = sheet.split("&&", 1) if "&&" in sheet else (sheet, sheet)
-        df = pd.read_excel(xls, sheet_name=sheet)
-        df = df[df.iloc[:, 0] == "Total"]
-        df = df.rename(columns={"Stress PnL": "StressPnL"})
-        df["Date"] = pd.to_datetime(df["Date"])
-        df["Portfolio"] = portfolio
-        df["ScenarioName"] = scenario_name
-        records.append(df[["Date", "Scenario", "StressPnL", "Portfolio", "ScenarioName"]])
-    return pd.concat(records, ignore_index=True)
+    pq_dir = parquet_dir(path)
+    if pq_dir:
+        df = ds.dataset(pq_dir, partitioning=STRESS_PARTITIONING).to_table(
+            columns=STRESS_COLS,
+            filter=ds.field("Name") == "Total"
+        ).to_pandas()
+    else:
+        wb = CalamineWorkbook.from_path(path)
+
+        def parse_sheet(sheet):
+            portfolio, scenario_name = split_sheet_name(sheet)
+            # solo header + righe "Total" arrivano a pandas
+            rows = wb.get_sheet_by_name(sheet).iter_rows()
+            header = next(rows)
+            totals = [r for r in rows if r and r[0] == "Total"]
+            df = pd.DataFrame.from_records(blank_to_none(totals), columns=header)
+            df = df.rename(columns={"Stress PnL": "StressPnL"})
+            df["Date"] = pd.to_datetime(df["Date"])
+            df["Portfolio"] = portfolio
+            df["ScenarioName"] = scenario_name
+            return df[STRESS_COLS]
+
+        records = [parse_sheet(sheet) for sheet in wb.sheet_names]
+        df = pd.concat(records, ignore_index=True)
+    positions = sheet_positions(path)
+    df["SheetPos"] = [positions[key] for key in zip(df["Portfolio"], df["ScenarioName"])]
+    portfolios, scenarios = sheet_categories(path)
+    df["Scenario"] = df["Scenario"].astype("category")
+    df["Portfolio"] = df["Portfolio"].astype(portfolios)
+    df["ScenarioName"] = df["ScenarioName"].astype(scenarios)
+    return df.set_index(["Date", "Portfolio", "ScenarioName"]).sort_index()
 
 @st.cache_data
+@disk_cache
 def load_stress_bystrat(path):
-    xls = pd.ExcelFile(path)
-    records = []
-    for sheet in xls.sheet_names:
-        portfolio, scenario = sheet.split("&&", 1) if "&&" in sheet else (sheet, sheet)
-        df = pd.read_excel(xls, sheet_name=sheet)
-        name_col = df.columns[0]
-        date_col = df.columns[df.columns.str.contains("Date", case=False, regex=True)][0]
-        pnl_col = df.columns[df.columns.str.contains("Stress PnL", case=False, regex=True)][0]
-        df = df.rename(columns={name_col: "Name", date_col: "Date", pnl_col: "StressPnL"})
-        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
-        df["Portfolio"] = portfolio
-        df["ScenarioName"] = scenario
-        records.append(df[["Name", "Date", "StressPnL", "Portfolio", "ScenarioName"]])
-    combined = pd.concat(records, ignore_index=True)
-    combined = combined.sort_values(["Date", "Portfolio", "ScenarioName", "Name"])
-    return combined
+    pq_dir = parquet_dir(path)
+    if pq_dir:
+        combined = ds.dataset(pq_dir, partitioning=STRESS_PARTITIONING).to_table(
+            columns=BYSTRAT_COLS
+        ).to_pandas()
+    else:
+        wb = CalamineWorkbook.from_path(path)
+
+        def parse_sheet(sheet):
+            portfolio, scenario = split_sheet_name(sheet)
+            df = read_sheet(wb, sheet)
+            df = df.rename(columns=bystrat_header_map(tuple(df.columns)))
+            df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+            df["Portfolio"] = portfolio
+            df["ScenarioName"] = scenario
+            return df[BYSTRAT_COLS]
+
+        records = [parse_sheet(sheet) for sheet in wb.sheet_names]
+        combined = pd.concat(records, ignore_index=True)
+    # righe senza data o nome (mai selezionabili dalla UI) romperebbero il lexsort del MultiIndex
+    combined = combined.dropna(subset=["Date", "Name"])
+    portfolios, scenarios = sheet_categories(path)
+    combined["Name"] = combined["Name"].astype("category")
+    combined["Portfolio"] = combined["Portfolio"].astype(portfolios)
+    combined["ScenarioName"] = combined["ScenarioName"].astype(scenarios)
+    return combined.set_index(["Date", "Portfolio", "ScenarioName", "Name"]).sort_index()
+
+@st.cache_data
+def load_stress_options(path):
+    """Date → coppie (portafoglio, scenario) nell'ordine dei sheet, calcolate una volta sola fuori dal render"""
+    df = load_stress_data(path).reset_index().sort_values(["Date", "SheetPos"], kind="stable")
+    options = {}
+    for date, portfolio, scenario in zip(df["Date"], df["Portfolio"], df["ScenarioName"]):
+        options.setdefault(date, []).append((portfolio, scenario))
+    return options
+
+@st.cache_data
+def load_bystrat_dates(path):
+    """Date disponibili (ordinate) per l'analisi by strategy"""
+    return load_stress_bystrat(path).index.unique(level="Date").dropna().tolist()
 
 @st.cache_data
 def load_legenda(sheet, cols):
-    return pd.read_excel("Legenda.xlsx", sheet_name=sheet, usecols=cols)
+    return pd.read_excel("Legenda.xlsx", sheet_name=sheet, usecols=cols, engine="calamine")
+
+def slice_index(df, key, columns, sort_by=None):
+    """Selezione su MultiIndex ordinato → DataFrame piatto (chiave assente → vuoto),
+    eventualmente riordinato su sort_by (es. SheetPos → ordine dell'Excel)"""
+    try:
+        out = df.loc[key, :]
+    except KeyError:
+        out = df.iloc[:0]
+    out = out.reset_index()
+    if sort_by:
+        out = out.sort_values(sort_by, kind="stable")
+    return out[columns].reset_index(drop=True)
 
 # ==================================================
 # NAME MAP (Ticker → Name)
@@ -80,15 +262,49 @@ def load_name_map():
     return dict(zip(legenda["Ticker"], legenda["Name"]))
 
 NAME_MAP = load_name_map()
+NAME_SERIES = pd.Series(NAME_MAP, dtype=object)
 def pretty_name(x):
     return NAME_MAP.get(x, x)
 
+def pretty_names(xs):
+    """pretty_name vettorizzato su una lista di ticker"""
+    s = pd.Series(xs, dtype=object)
+    return s.map(NAME_SERIES).fillna(s).tolist()
+
+# ==================================================
+# EXCEL DOWNLOAD
+# ==================================================
+@st.cache_data
+def to_excel_bytes(df, sheet_name="Sheet1", index=True):
+    """Bytes xlsx per st.download_button (cache: rerun con la stessa selezione → stesso buffer)"""
+    output = BytesIO()
+    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+        df.to_excel(writer, sheet_name=sheet_name, index=index)
+    return output.getvalue()
+
+# ==================================================
+# BUCKET STATISTICS
+# ==================================================
+@st.cache_data
+def bucket_stats(df_b):
+    """Mediana e quartili 25/75% dello StressPnL del bucket per scenario (cache per selezione)"""
+    q = (
+        df_b.groupby("ScenarioName", observed=True)["StressPnL"]
+        .quantile([0.25, 0.5, 0.75])
+        .unstack()
+        .reindex(columns=[0.25, 0.5, 0.75])  # bucket vuoto (un solo portafoglio) → colonne comunque presenti
+    )
+    q.columns = ["q25", "bucket_median", "q75"]
+    return q[["bucket_median", "q25", "q75"]].reset_index()
+
 # ==================================================
 # LOAD DATA
 # ==================================================
 corr_sheets = load_corr_sheets("corr_ptf.xlsx")
 stress_data = load_stress_data("stress_test_bystrat.xlsx")
 stress_bystrat = load_stress_bystrat("stress_test_bystrat.xlsx")
+stress_options = load_stress_options("stress_test_bystrat.xlsx")
+dates_bystrat = load_bystrat_dates("stress_test_bystrat.xlsx")
 
 # ==================================================
 # TAB — CORRELATION
@@ -126,14 +342,25 @@ with tab_corr:
         )
 
     with col_plot:
+        # serie selezionate in %, calcolate una volta sola
+        sub = df[selected]
+        sub_pct = sub.mul(100)
+        # agg su zero colonne solleva "No objects to concatenate" (multiselect svuotata)
+        sub_agg_pct = (
+            sub.agg(["mean", "min", "max"]) if selected
+            else pd.DataFrame(index=["mean", "min", "max"], dtype=np.float64)
+        ).mul(100)
+        sub_mean_pct = sub_agg_pct.loc["mean"]
+        names = pretty_names(selected)
+
         st.subheader(f"Correlation ex-Ante Time Series - {pretty_name(selected_sheet)}")
         fig = go.Figure()
         palette = qualitative.Plotly
-        for i, c in enumerate(selected):
-            fig.add_trace(go.Scatter(
-                x=df.index,
-                y=df[c] * 100,
-                name=pretty_name(c),
+        for i, (c, name) in enumerate(zip(selected, names)):
+            fig.add_trace(go.Scattergl(
+                x=sub_pct.index,
+                y=sub_pct[c],
+                name=name,
                 line=dict(color=palette[i % len(palette)])
             ))
         fig.update_layout(
@@ -147,30 +374,27 @@ with tab_corr:
         st.plotly_chart(fig, use_container_width=True)
 
         # Download Excel
-        output = BytesIO()
-        (df[selected] * 100).to_excel(output)
         st.download_button(
             "📥 Download Correlation Time Series as Excel",
-            output.getvalue(),
+            to_excel_bytes(sub_pct),
             "correlation_time_series.xlsx"
         )
 
         # Radar chart
         st.subheader(f"Correlation Radar ex-Ante - {pretty_name(selected_sheet)}")
         snapshot_date = df.index.max()
-        snapshot = df.loc[snapshot_date, selected]
-        mean_corr = df[selected].mean()
-        theta = [pretty_name(c) for c in selected]
+        snapshot = sub_pct.loc[snapshot_date]
+        theta = names
 
         fig_radar = go.Figure()
         fig_radar.add_trace(go.Scatterpolar(
-            r=snapshot.values * 100,
+            r=snapshot.values,
             theta=theta,
             name=f"End date ({snapshot_date.date()})",
             line=dict(width=3)
         ))
         fig_radar.add_trace(go.Scatterpolar(
-            r=mean_corr.values * 100,
+            r=sub_mean_pct.values,
             theta=theta,
             name="Period mean",
             line=dict(dash="dot")
@@ -183,21 +407,22 @@ with tab_corr:
 
         # Summary Statistics
         st.subheader(f"Summary Statistics - {pretty_name(selected_sheet)}")
+        # index invertito → idxmin/idxmax restituiscono l'ultima data in caso di pari merito
+        sub_rev = sub.iloc[::-1]
         stats_df = pd.DataFrame(index=selected)
-        stats_df.insert(0, "Name", [pretty_name(s) for s in selected])
-        stats_df["Mean (%)"] = df[selected].mean() * 100
-        stats_df["Min (%)"] = df[selected].min() * 100
-        stats_df["Min Date"] = [df[col][df[col] == df[col].min()].index.max() for col in selected]
-        stats_df["Max (%)"] = df[selected].max() * 100
-        stats_df["Max Date"] = [df[col][df[col] == df[col].max()].index.max() for col in selected]
-        stats_df["Min Date"] = pd.to_datetime(stats_df["Min Date"]).dt.strftime("%d/%m/%Y")
-        stats_df["Max Date"] = pd.to_datetime(stats_df["Max Date"]).dt.strftime("%d/%m/%Y")
+        stats_df.insert(0, "Name", names)
+        stats_df["Mean (%)"] = sub_mean_pct
+        stats_df["Min (%)"] = sub_agg_pct.loc["min"]
+        stats_df["Min Date"] = pd.to_datetime(sub_rev.idxmin()).dt.strftime("%d/%m/%Y").values
+        stats_df["Max (%)"] = sub_agg_pct.loc["max"]
+        stats_df["Max Date"] = pd.to_datetime(sub_rev.idxmax()).dt.strftime("%d/%m/%Y").values
         st.dataframe(stats_df.style.format({"Mean (%)": "{:.2f}%", "Min (%)": "{:.2f}%", "Max (%)": "{:.2f}%"}), use_container_width=True)
 
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            stats_df.to_excel(writer, sheet_name="Summary Statistics", index=False)
-        st.download_button("📥 Download Summary Statistics as Excel", output.getvalue(), "summary_statistics.xlsx")
+        st.download_button(
+            "📥 Download Summary Statistics as Excel",
+            to_excel_bytes(stats_df, sheet_name="Summary Statistics", index=False),
+            "summary_statistics.xlsx"
+        )
 
 # ==================================================
 # TAB — STRESS TEST
@@ -213,7 +438,7 @@ with tab_stress:
         # ------------------------------
         # Selezione data principale per Stress Test
         # ------------------------------
-        dates = sorted(stress_data["Date"].unique())
+        dates = list(stress_options)
         date = pd.to_datetime(
             st.selectbox(
                 "Select date",  # label condivisa
@@ -222,26 +447,23 @@ with tab_stress:
             )
         )
 
-        df = stress_data[stress_data["Date"] == date]
-
         # Selezione Portfolios
-        portfolios = df["Portfolio"].unique().tolist()
+        portfolios = list(dict.fromkeys(p for p, _ in stress_options[date]))
         sel_ports = st.multiselect(
             "Select portfolios",
             portfolios,
             default=portfolios,
             format_func=pretty_name
         )
-        df = df[df["Portfolio"].isin(sel_ports)]
 
         # Selezione Scenarios
-        scenarios = df["ScenarioName"].unique().tolist()
+        scenarios = list(dict.fromkeys(s for p, s in stress_options[date] if p in sel_ports))
         sel_scen = st.multiselect(
             "Select scenarios",
             scenarios,
             default=scenarios
         )
-        df = df[df["ScenarioName"].isin(sel_scen)]
+        df = slice_index(stress_data, pd.IndexSlice[date, sel_ports, sel_scen], STRESS_COLS, sort_by="SheetPos")
 
     with col_plot:
         # ------------------------------
@@ -268,12 +490,9 @@ with tab_stress:
         st.plotly_chart(fig, use_container_width=True)
 
         # Download Excel
-        output = BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, sheet_name="Stress Test PnL", index=False)
         st.download_button(
             label="📥 Download Stress PnL as Excel",
-            data=output.getvalue(),
+            data=to_excel_bytes(df, sheet_name="Stress Test PnL", index=False),
             file_name="stress_test_pnl.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             key="download_stress_pnl"
@@ -287,7 +506,6 @@ with tab_stress:
             # --------------------
             # Selezione data by strategy
             # --------------------
-            dates_bystrat = sorted(stress_bystrat["Date"].dropna().unique())
             selected_date = pd.to_datetime(
                 st.selectbox(
                     "Select date",
@@ -313,12 +531,12 @@ with tab_stress:
             # --------------------
             # Filtra dati per strategia
             # --------------------
-            df_detail = stress_bystrat[
-                (stress_bystrat["Date"] == selected_date) &
-                (stress_bystrat["Portfolio"] == clicked_portfolio) &
-                (stress_bystrat["ScenarioName"] == clicked_scenario) &
-                (stress_bystrat["Name"] != "Total")  # esclude la riga Total
-            ]
+            df_detail = slice_index(
+                stress_bystrat,
+                pd.IndexSlice[selected_date, clicked_portfolio, clicked_scenario, :],
+                BYSTRAT_COLS
+            )
+            df_detail = df_detail[df_detail["Name"] != "Total"]  # esclude la riga Total
             df_detail = df_detail.copy()
 
             df_detail["StressPnL"] = (
@@ -326,47 +544,18 @@ with tab_stress:
                 .fillna(0.0)
             )
             if not df_detail.empty:
-                # --------------------
-                # Prepara colori dinamici
-                # --------------------
-                vals = pd.to_numeric(df_detail["StressPnL"], errors="coerce").fillna(0).values
-                max_abs = np.max(np.abs(vals)) if np.max(np.abs(vals)) != 0 else 1
-                
-                colors = []
-                for v in vals:
-                    v = float(v)  # assicuriamoci sia float
-                    neg = int(np.clip(255 * abs(min(0, v) / max_abs), 0, 255))
-                    pos = int(np.clip(255 * max(0, v) / max_abs, 0, 255))
-                    colors.append(f"rgba({neg},{pos},0,0.8)")
-        
-                df_tm = df_detail.copy()
-                df_tm["size"] = df_tm["StressPnL"].abs().clip(lower=0.01)
+                size = np.maximum(np.abs(df_detail["StressPnL"].to_numpy(dtype=np.float64)), 0.01)
         
                 # --------------------
-                # Treemap
+                # Treemap (colori = StressPnL sulla scala RdYlGn)
                 # --------------------
                 root_label = f"{pretty_name(clicked_portfolio)} - {clicked_scenario} ({selected_date.date()})"
         
-                labels = [root_label] + df_tm["Name"].tolist()
-                parents = [""] + [root_label] * len(df_tm)
-                values = [df_tm["size"].sum()] + df_tm["size"].tolist()
-                colors = ["white"] + colors
-                texts = [""] + df_tm["StressPnL"].round(2).astype(str).tolist()
-        
-                vals = df_detail["StressPnL"].values
-                max_abs = np.max(np.abs(vals)) if np.max(np.abs(vals)) != 0 else 1
-                colors = [
-                    f"rgba({int(255*abs(min(0,v)/max_abs))},{int(255*max(0,v)/max_abs)},0,0.8)"
-                    for v in vals
-                ]
-                
-                df_tm = df_detail.copy()
-                df_tm["size"] = df_tm["StressPnL"].abs().clip(lower=0.01)                
-                labels = [root_label] + df_tm.iloc[:, 0].tolist()
-                parents = [""] + [root_label] * len(df_tm)
-                values = [df_tm["size"].sum()] + df_tm["size"].tolist()
-                colors = ["white"] + df_tm["StressPnL"].tolist()
-                texts = [""] + df_tm["StressPnL"].round(2).astype(str).tolist()
+                labels = [root_label] + df_detail["Name"].tolist()
+                parents = [""] + [root_label] * len(df_detail)
+                values = [size.sum()] + size.tolist()
+                colors = ["white"] + df_detail["StressPnL"].tolist()
+                texts = [""] + df_detail["StressPnL"].round(2).astype(str).tolist()
                 
                 fig_detail = go.Figure(
                     go.Treemap(
@@ -399,14 +588,9 @@ with tab_stress:
                 st.plotly_chart(fig_detail, use_container_width=True)
         
                 # Download Excel
-                output = BytesIO()
-                with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                    df_detail.to_excel(writer, sheet_name="StressPnL By Strategy", index=False)
-                output.seek(0)
-        
                 st.download_button(
                     label="📥 Download StressPnL By Strategy as Excel",
-                    data=output.getvalue(),
+                    data=to_excel_bytes(df_detail, sheet_name="StressPnL By Strategy", index=False),
                     file_name="stress_by_strategy.xlsx",
                     mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
                     key="download_stress_by_strategy"
@@ -436,29 +620,27 @@ with tab_stress:
         # Bucket = tutti gli altri
         df_b = df[df["Portfolio"] != selected_portfolio]
         
-        bucket = (
-            df_b.groupby("ScenarioName")["StressPnL"]
-            .agg(
-                bucket_median="median",
-                q25=lambda x: x.quantile(0.25),
-                q75=lambda x: x.quantile(0.75)
-            )
-            .reset_index()
-        )
+        bucket = bucket_stats(df_b)
         
         plot_df = df_p.merge(bucket, on="ScenarioName")
         
         fig = go.Figure()
         
-        # bande 25–75%
-        for _, r in plot_df.iterrows():
-            fig.add_trace(go.Scatter(
-                x=[r.q25, r.q75],
-                y=[r.ScenarioName] * 2,
-                mode="lines",
-                line=dict(width=14, color="rgba(0,0,255,0.25)"),
-                showlegend=False
-            ))
+        # bande 25–75%: un'unica traccia, segmenti separati da gap (NaN / None)
+        band_x = np.column_stack([
+            plot_df["q25"].to_numpy(dtype=np.float64),
+            plot_df["q75"].to_numpy(dtype=np.float64),
+            np.full(len(plot_df), np.nan)
+        ]).ravel()
+        band_y = np.repeat(plot_df["ScenarioName"].to_numpy(dtype=object), 3)
+        band_y[2::3] = None
+        fig.add_trace(go.Scatter(
+            x=band_x,
+            y=band_y,
+            mode="lines",
+            line=dict(width=14, color="rgba(0,0,255,0.25)"),
+            showlegend=False
+        ))
         
         # mediana bucket
         fig.add_trace(go.Scatter(
@@ -498,15 +680,11 @@ with tab_stress:
         )
         
         # Download Excel
-        output = BytesIO()
-        plot_df.to_excel(output, index=False)
-        output.seek(0)
-        
         pretty_portfolio_name = pretty_name(selected_portfolio)
         
         st.download_button(
             label=f"📥 Download {pretty_portfolio_name} vs Bucket Stress Test as Excel",
-            data=output.getvalue(),
+            data=to_excel_bytes(plot_df, index=False),
             file_name=f"{pretty_portfolio_name.replace(' ', '_').lower()}_vs_bucket_stress_test.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
             key="download_comparison_stress_test"
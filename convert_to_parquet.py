@@ -0,0 +1,70 @@
+"""
+Conversione una tantum degli input Excel in Parquet.
+
+    python convert_to_parquet.py
+
+- corr_ptf.xlsx            -> corr_ptf/<sheet>.parquet (un file per sheet)
+- stress_test_bystrat.xlsx -> stress_test_bystrat/ (dataset partizionato
+                              per Portfolio / ScenarioName)
+
+Ogni cartella contiene anche _sheets.json con l'ordine dei sheet del workbook,
+scritto per ultimo. app.py legge i Parquet solo se _sheets.json esiste ed è più
+recente dell'xlsx, altrimenti ricade sugli xlsx (rilanciare lo script dopo ogni
+aggiornamento degli input).
+"""
+import json
+import os
+import shutil
+
+import pandas as pd
+from python_calamine import CalamineWorkbook
+
+from sheet_utils import PARQUET_MANIFEST, blank_to_none, bystrat_header_map, split_sheet_name
+
+
+def reset_dir(out_dir):
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.makedirs(out_dir)
+
+
+def write_manifest(out_dir, sheets):
+    with open(os.path.join(out_dir, PARQUET_MANIFEST), "w") as f:
+        json.dump(sheets, f)
+
+
+def convert_corr(path):
+    out_dir = os.path.splitext(path)[0]
+    reset_dir(out_dir)
+    xls = pd.ExcelFile(path, engine="calamine")
+    for sheet in xls.sheet_names:
+        df = pd.read_excel(xls, sheet_name=sheet)
+        df.to_parquet(os.path.join(out_dir, f"{sheet}.parquet"), index=False)
+    write_manifest(out_dir, xls.sheet_names)
+
+
+def convert_stress(path):
+    out_dir = os.path.splitext(path)[0]
+    wb = CalamineWorkbook.from_path(path)
+    records = []
+    for sheet in wb.sheet_names:
+        portfolio, scenario_name = split_sheet_name(sheet)
+        rows = wb.get_sheet_by_name(sheet).to_python(skip_empty_area=False)
+        df = pd.DataFrame(blank_to_none(rows[1:]), columns=rows[0])
+        df = df.rename(columns=bystrat_header_map(tuple(df.columns)))
+        # la colonna Date mescola testo ("12/31/2025") e celle data: parsing per sheet,
+        # come fanno i loader xlsx di app.py, e salvataggio come timestamp
+        df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
+        df["Portfolio"] = portfolio
+        df["ScenarioName"] = scenario_name
+        records.append(df[["Name", "Date", "Scenario", "StressPnL", "Portfolio", "ScenarioName"]])
+    combined = pd.concat(records, ignore_index=True)
+    combined = combined.astype({"Name": "string", "Scenario": "string"})
+    combined["StressPnL"] = pd.to_numeric(combined["StressPnL"], errors="coerce")
+    reset_dir(out_dir)
+    combined.to_parquet(out_dir, partition_cols=["Portfolio", "ScenarioName"], index=False)
+    write_manifest(out_dir, wb.sheet_names)
+
+
+if __name__ == "__main__":
+    convert_corr("corr_ptf.xlsx")
+    convert_stress("stress_test_bystrat.xlsx")
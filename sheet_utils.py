@@ -0,0 +1,29 @@
+"""
+Helper condivisi per la lettura dei workbook, usati da app.py e da
+convert_to_parquet.py (app.py non è importabile: avvia la UI Streamlit).
+"""
+import functools
+
+import pandas as pd
+
+# manifest con l'ordine dei sheet, scritto per ultimo nelle cartelle Parquet
+PARQUET_MANIFEST = "_sheets.json"
+
+
+def blank_to_none(rows):
+    """Celle vuote di calamine ("") → None, prima di costruire il DataFrame (dtype inferiti da pandas)"""
+    return [[None if v == "" else v for v in r] for r in rows]
+
+
+def split_sheet_name(sheet):
+    """Nome sheet "<Portfolio>&&<ScenarioName>" → (Portfolio, ScenarioName); senza && entrambi = sheet"""
+    return tuple(sheet.split("&&", 1)) if "&&" in sheet else (sheet, sheet)
+
+
+@functools.lru_cache(maxsize=None)
+def bystrat_header_map(columns):
+    """Rinomina Name/Date/StressPnL, calcolata una volta per schema di header (gli sheet condividono lo schema)"""
+    columns = pd.Index(columns)
+    date_col = columns[columns.str.contains("Date", case=False, regex=True)][0]
+    pnl_col = columns[columns.str.contains("Stress PnL", case=False, regex=True)][0]
+    return {columns[0]: "Name", date_col: "Date", pnl_col: "StressPnL"}